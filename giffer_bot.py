@@ -1,19 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import io
+import functools
 import os
 import re
 import time
 import random
 import logging
+import threading
 import socket
-import tempfile
+import shutil
 import subprocess
 import json
+from collections import deque
+from dataclasses import dataclass, field
 from logging.handlers import RotatingFileHandler
-from typing import Optional, Tuple, Dict, Any, Callable, TypeVar, List
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Optional, Tuple, Dict, Any, List, Deque, Union, cast
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -28,6 +31,41 @@ try:
 except Exception:
     imageio_ffmpeg = None  # type: ignore
 
+try:
+    import orjson
+except Exception:
+    orjson = None  # type: ignore
+
+
+# download_bytes may hand back its preallocated bytearray; consumers only need a buffer
+BytesLike = Union[bytes, bytearray]
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+
+# =======================
+# PRECOMPILED REGEXES
+# =======================
+
+_RE_TAG = re.compile(r"<[^>]+>")
+_RE_WS = re.compile(r"\s+")
+_RE_NSFW = re.compile(r"\bnsfw\b")
+# runs of mentions / nsfw words swallow their surrounding whitespace, so one sub also collapses it
+_RE_MENTIONS_WS = re.compile(r"(?:\s*@\s*[a-z0-9_]+(?:@[a-z0-9\.\-]+)?)+\s*|\s+", re.I)
+_RE_NSFW_WS = re.compile(r"(?:\s*\bnsfw\b)+\s*")
+_RE_TRAIL_COMMENT = re.compile(r"\s+#")
+_RE_TOKENS = re.compile(r'"([^"]+)"|(\S+)')
+
 
 # =======================
 # ENV loader (Windows-friendly)
@@ -49,7 +87,7 @@ def load_env_file(path: str = "config.env") -> None:
             v = v.strip()
 
             if v and v[0] not in "\"'":
-                m = re.search(r"\s+#", v)
+                m = _RE_TRAIL_COMMENT.search(v)
                 if m:
                     v = v[: m.start()].rstrip()
 
@@ -76,6 +114,7 @@ NSFW_FILTER_ID = os.getenv("NSFW_FILTER_ID", "").strip()
 USER_AGENT = os.getenv("USER_AGENT", "giffer-bot/3.3 (by @giffer@bronyfurry.com)").strip()
 
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "30"))
+NOTIF_WORKERS = max(1, int(os.getenv("NOTIF_WORKERS", "8")))  # mentions handled concurrently
 
 # Rate-limit / anti-spam
 USER_COOLDOWN_SEC = int(os.getenv("USER_COOLDOWN_SEC", "20"))
@@ -86,14 +125,18 @@ GLOBAL_BURST = int(os.getenv("GLOBAL_BURST", "3"))
 CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "5"))
 READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", "20"))
 SOCKET_DEFAULT_TIMEOUT = float(os.getenv("SOCKET_DEFAULT_TIMEOUT", "25"))
+DNS_CACHE_TTL = float(os.getenv("DNS_CACHE_TTL", "300"))  # 0 disables the DNS cache
 
-# Watchdog for Mastodon calls
+# Socket timeout for Mastodon API calls
 MASTO_CALL_TIMEOUT = float(os.getenv("MASTO_CALL_TIMEOUT", "25"))
 
 # Media download safety
 MAX_GIF_BYTES = int(os.getenv("MAX_GIF_BYTES", str(25 * 1024 * 1024)))  # 25MB
 DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "40"))
 
+# GIF -> MP4 conversion
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "120"))
+
 # Wait for Mastodon media processing
 MEDIA_PROCESS_MAX_WAIT = float(os.getenv("MEDIA_PROCESS_MAX_WAIT", "60"))
 
@@ -105,7 +148,7 @@ LOG_FILE = os.getenv("LOG_FILE", "giffer.log").strip() or "giffer.log"
 
 # State (for "do not reply twice")
 STATE_FILE = os.getenv("STATE_FILE", "giffer_state.json").strip() or "giffer_state.json"
-PROCESSED_CACHE_MAX = int(os.getenv("PROCESSED_CACHE_MAX", "800"))  # how many status_ids to remember
+PROCESSED_CACHE_MAX = max(1, int(os.getenv("PROCESSED_CACHE_MAX", "800")))  # how many status_ids to remember
 
 
 # =======================
@@ -133,11 +176,29 @@ logger.addHandler(fh)
 
 socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
 
+_orig_getaddrinfo = socket.getaddrinfo
+
+
+@functools.lru_cache(maxsize=64)
+def _getaddrinfo_cached(host, port, family, type_, proto, flags, _bucket):
+    return tuple(_orig_getaddrinfo(host, port, family, type_, proto, flags))
+
+
+def cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    # _bucket rolls over every DNS_CACHE_TTL seconds, so stale entries age out
+    bucket = int(time.monotonic() // max(DNS_CACHE_TTL, 1.0))
+    return list(_getaddrinfo_cached(host, port, family, type, proto, flags, bucket))
+
+
+if DNS_CACHE_TTL > 0:
+    socket.getaddrinfo = cached_getaddrinfo
+
 
 def make_session() -> requests.Session:
     s = requests.Session()
-    s.headers.update({"User-Agent": USER_AGENT})
+    s.headers.update({"User-Agent": USER_AGENT, "Connection": "keep-alive"})
 
+    # pools: few distinct hosts (furbooru API + CDN), maxsize matches worker concurrency
     if Retry is not None:
         retry = Retry(
             total=3,
@@ -149,9 +210,9 @@ def make_session() -> requests.Session:
             allowed_methods=("GET", "POST"),
             raise_on_status=False,
         )
-        adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8, pool_block=False)
     else:
-        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, pool_block=False)
 
     s.mount("https://", adapter)
     s.mount("http://", adapter)
@@ -160,61 +221,77 @@ def make_session() -> requests.Session:
 
 http = make_session()
 
-_executor = ThreadPoolExecutor(max_workers=4)
-T = TypeVar("T")
-
-
-def run_with_timeout(fn: Callable[[], T], timeout: float, what: str) -> Optional[T]:
-    fut = _executor.submit(fn)
-    try:
-        return fut.result(timeout=timeout)
-    except FuturesTimeoutError:
-        logger.error("Timeout: %s (>%ss). Continuing.", what, timeout)
-        return None
-    except Exception as e:
-        logger.error("Error in %s: %s", what, e)
-        return None
+# background GIF->MP4 encodes; each x264 run already uses every core (-threads 0),
+# so keep the pool small and let rare concurrent 422 fallbacks queue instead
+_executor = ThreadPoolExecutor(max_workers=2)
+# separate pool: handlers wait on encode futures, so sharing one pool could deadlock
+_notif_executor = ThreadPoolExecutor(max_workers=NOTIF_WORKERS)
 
 
 # =======================
 # STATE (persist last_seen + processed status_ids)
 # =======================
 
+def _new_state(last_seen_notif_id: Optional[int], processed_ids: List[Any]) -> Dict[str, Any]:
+    # dedupe (keep order) so every deque entry maps to exactly one set entry
+    ids = list(dict.fromkeys(int(x) for x in processed_ids if isinstance(x, int) or str(x).isdigit()))
+    dq: Deque[int] = deque(ids, maxlen=PROCESSED_CACHE_MAX)
+    return {
+        "last_seen_notif_id": last_seen_notif_id,
+        # in-memory only: set for O(1) lookups, deque for FIFO eviction
+        "processed_set": set(dq),
+        "processed_deque": dq,
+    }
+
 def load_state() -> Dict[str, Any]:
     if not os.path.exists(STATE_FILE):
-        return {"last_seen_notif_id": None, "processed_status_ids": []}
+        return _new_state(None, [])
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if "last_seen_notif_id" not in data:
-            data["last_seen_notif_id"] = None
-        if "processed_status_ids" not in data or not isinstance(data["processed_status_ids"], list):
-            data["processed_status_ids"] = []
-        return data
+        with open(STATE_FILE, "rb") as f:
+            data = _json_loads(f.read())
+        ids = data.get("processed_status_ids")
+        if not isinstance(ids, list):
+            ids = []
+        return _new_state(data.get("last_seen_notif_id"), ids)
     except Exception as e:
         logger.warning("Failed to read state file (%s). Starting fresh.", e)
-        return {"last_seen_notif_id": None, "processed_status_ids": []}
+        return _new_state(None, [])
+
+_last_state_bytes: Optional[bytes] = None
 
 def save_state(state: Dict[str, Any]) -> None:
+    global _last_state_bytes
+    data = {
+        "last_seen_notif_id": state.get("last_seen_notif_id"),
+        "processed_status_ids": list(state["processed_deque"]),
+    }
     try:
+        raw = _json_dumps(data)
+        if raw == _last_state_bytes:
+            return  # nothing changed since the last successful write
         tmp = STATE_FILE + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False)
+        with open(tmp, "wb") as f:
+            f.write(raw)
         os.replace(tmp, STATE_FILE)
+        _last_state_bytes = raw
     except Exception as e:
         logger.warning("Failed to write state file: %s", e)
 
 def remember_processed(state: Dict[str, Any], status_id: int) -> None:
-    arr = state.get("processed_status_ids", [])
-    arr.append(int(status_id))
-    # keep last N
-    if len(arr) > PROCESSED_CACHE_MAX:
-        arr = arr[-PROCESSED_CACHE_MAX:]
-    state["processed_status_ids"] = arr
+    sid = int(status_id)
+    seen: set = state["processed_set"]
+    dq: Deque[int] = state["processed_deque"]
+    if sid in seen:
+        return
+    # keep last N: deque drops the oldest id on append, so drop it from the set too
+    if len(dq) == dq.maxlen:
+        seen.discard(dq[0])
+    dq.append(sid)
+    seen.add(sid)
 
 def is_processed(state: Dict[str, Any], status_id: int) -> bool:
     try:
-        return int(status_id) in set(state.get("processed_status_ids", []))
+        return int(status_id) in state["processed_set"]
     except Exception:
         return False
 
@@ -223,13 +300,49 @@ def is_processed(state: Dict[str, Any], status_id: int) -> bool:
 # RATE LIMIT HELPERS
 # =======================
 
+@dataclass
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    last: float = field(default_factory=time.monotonic)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def reserve(self) -> float:
+        """Take one token; return how long the caller must sleep before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1.0
+            if self.tokens >= 0.0:
+                return 0.0
+            # token is borrowed from the future; refill pays it back
+            return -self.tokens / self.rate
+
+
 _user_last: Dict[str, float] = {}
-_global_tokens = float(GLOBAL_BURST)
-_global_last = time.monotonic()
+_USER_SWEEP_EVERY = 64
+_user_calls = 0
+_global_bucket = TokenBucket(
+    rate=max(GLOBAL_RATE_PER_SEC, 0.001),
+    burst=float(GLOBAL_BURST),
+    tokens=float(GLOBAL_BURST),
+)
+
+
+def _sweep_user_last(now: float) -> None:
+    # entries past the cooldown can never block anyone; drop them
+    for acct in [a for a, ts in _user_last.items() if now - ts >= USER_COOLDOWN_SEC]:
+        del _user_last[acct]
 
 
 def user_allowed(acct: str) -> bool:
+    global _user_calls
     now = time.time()
+    _user_calls += 1
+    if _user_calls % _USER_SWEEP_EVERY == 0:
+        _sweep_user_last(now)
     last = _user_last.get(acct, 0.0)
     if now - last < USER_COOLDOWN_SEC:
         logger.info("Cooldown hit for user=%s (wait %.1fs)", acct, USER_COOLDOWN_SEC - (now - last))
@@ -239,40 +352,35 @@ def user_allowed(acct: str) -> bool:
 
 
 def global_wait_if_needed() -> None:
-    global _global_tokens, _global_last
-    now = time.monotonic()
-    elapsed = now - _global_last
-    _global_last = now
-
-    _global_tokens = min(float(GLOBAL_BURST), _global_tokens + elapsed * GLOBAL_RATE_PER_SEC)
-
-    if _global_tokens >= 1.0:
-        _global_tokens -= 1.0
+    need = _global_bucket.reserve()
+    if need <= 0.0:
         return
-
-    need = (1.0 - _global_tokens) / max(GLOBAL_RATE_PER_SEC, 0.001)
+    # sleep outside the lock so other callers can queue their own reservations
     logger.info("Global rate-limit wait %.2fs", need)
-    time.sleep(max(0.0, need))
-    _global_tokens = 0.0
+    time.sleep(need)
 
 
 # =======================
 # TEXT HELPERS
 # =======================
 
+_BLOCK_TAGS = frozenset({"safe", "questionable", "explicit", "nsfw", "sfw", "animated", "gif"})
+_VISIBILITIES = frozenset({"public", "unlisted", "private", "direct"})
+_RANDOM_TOKENS = frozenset({"random", "rnd"})
+_UNDERSCORE_TABLE = str.maketrans({"_": " "})
+
 def strip_html(html: str) -> str:
-    text = re.sub(r"<[^>]+>", " ", html)
-    return re.sub(r"\s+", " ", text).strip()
+    text = _RE_TAG.sub(" ", html)
+    return _RE_WS.sub(" ", text).strip()
 
 
 def parse_query(content_html: str) -> Tuple[str, bool]:
-    text = strip_html(content_html).lower()
-    text = re.sub(r"@\s*[a-z0-9_]+(?:@[a-z0-9\.\-]+)?", " ", text, flags=re.I)
-    text = re.sub(r"\s+", " ", text).strip()
+    text = _RE_MENTIONS_WS.sub(" ", strip_html(content_html).lower()).strip()
 
-    is_nsfw = bool(re.search(r"\bnsfw\b", text))
-    text = re.sub(r"\bnsfw\b", " ", text).strip()
-    text = re.sub(r"\s+", " ", text).strip()
+    # detect after mention removal so e.g. @user@nsfw.social doesn't count
+    is_nsfw = "nsfw" in text and bool(_RE_NSFW.search(text))
+    if is_nsfw:
+        text = _RE_NSFW_WS.sub(" ", text).strip()
     return text, is_nsfw
 
 
@@ -281,19 +389,19 @@ def split_tags(query: str) -> List[str]:
     if not q:
         return []
     q = q.replace(",", " ")
-    parts = re.findall(r'"([^"]+)"|(\S+)', q)
+    parts = _RE_TOKENS.findall(q)
     tokens = []
     for a, b in parts:
         t = (a or b).strip()
         if t:
             tokens.append(t)
-    tokens = [t for t in tokens if t.lower() not in {"random", "rnd"}]
+    tokens = [t for t in tokens if t.lower() not in _RANDOM_TOKENS]
     return tokens
 
 
 def safe_visibility(v: str) -> str:
     v = (v or "public").strip().lower()
-    return v if v in {"public", "unlisted", "private", "direct"} else "public"
+    return v if v in _VISIBILITIES else "public"
 
 
 def make_alt_text(img: Dict[str, Any], query: str, is_nsfw: bool) -> str:
@@ -305,23 +413,16 @@ def make_alt_text(img: Dict[str, Any], query: str, is_nsfw: bool) -> str:
     else:
         raw = []
 
-    block = {"safe", "questionable", "explicit", "nsfw", "sfw", "animated", "gif"}
     cleaned = []
     for t in raw:
         if not t:
             continue
-        t2 = t.lower().strip()
-        if t2 in block:
+        t2 = t.lower()  # raw tags are already stripped
+        if t2 in _BLOCK_TAGS:
             continue
-        cleaned.append(t2.replace("_", " "))
+        cleaned.append(t2.translate(_UNDERSCORE_TABLE))
 
-    seen = set()
-    uniq = []
-    for t in cleaned:
-        if t in seen:
-            continue
-        seen.add(t)
-        uniq.append(t)
+    uniq = list(dict.fromkeys(cleaned))  # dedupe, keep order
 
     prefix = "NSFW animated GIF" if is_nsfw else "Animated GIF"
     if uniq:
@@ -345,6 +446,18 @@ def source_link(img: Dict[str, Any]) -> str:
 # FURBOORU
 # =======================
 
+REP_ORDER = ("full", "large", "medium", "small", "thumb")  # big -> small
+REP_KEYS = frozenset(REP_ORDER)
+
+
+def _is_gif_candidate(img: Dict[str, Any]) -> bool:
+    if img.get("format") != "gif" or not img.get("thumbnails_generated", False):
+        return False
+    reps = img.get("representations") or {}
+    present = REP_KEYS & reps.keys()
+    return any(reps[k] for k in present)
+
+
 def furbooru_search_gif(query: str, nsfw: bool) -> Optional[Dict[str, Any]]:
     global_wait_if_needed()
 
@@ -388,52 +501,87 @@ def furbooru_search_gif(query: str, nsfw: bool) -> Optional[Dict[str, Any]]:
             return None
 
         images = data.get("images", [])
-        candidates = []
+        # reservoir sampling (k=1): uniform pick in one pass, no candidates list
+        chosen = None
+        n = 0
         for img in images:
-            if img.get("format") != "gif":
-                continue
-            if not img.get("thumbnails_generated", False):
+            if not _is_gif_candidate(img):
                 continue
-            reps = img.get("representations") or {}
-            if not any(reps.get(k) for k in ("full", "large", "medium", "small", "thumb")):
-                continue
-            candidates.append(img)
+            n += 1
+            if random.randrange(n) == 0:
+                chosen = img
 
-        logger.info("Furbooru found=%d candidates=%d", len(images), len(candidates))
-        return random.choice(candidates) if candidates else None
+        logger.info("Furbooru found=%d candidates=%d", len(images), n)
+        return chosen
 
     return None
 
 
 def representation_candidates(img: Dict[str, Any]) -> List[str]:
     reps = img.get("representations") or {}
-    keys = ["full", "large", "medium", "small", "thumb"]
     out: List[str] = []
-    for k in keys:
+    for k in REP_ORDER:
         u = reps.get(k)
         if isinstance(u, str) and u.startswith("http") and u not in out:
             out.append(u)
     return out
 
 
-def download_bytes(url: str, max_bytes: int) -> Optional[bytes]:
+def _expected_length(r: requests.Response) -> Optional[int]:
+    # Content-Length is the encoded size; only trust it for identity bodies
+    if r.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    try:
+        n = int(r.headers.get("Content-Length", ""))
+    except ValueError:
+        return None
+    return n if n > 0 else None
+
+
+def download_bytes(url: str, max_bytes: int) -> Optional[BytesLike]:
     logger.info("Downloading %s", url)
     try:
         with http.get(url, timeout=(CONNECT_TIMEOUT, DOWNLOAD_TIMEOUT), stream=True) as r:
             if r.status_code >= 400:
                 logger.error("Download HTTP %s", r.status_code)
                 return None
-            total = 0
-            chunks = []
+
+            expected = _expected_length(r)
+            if expected is not None and expected > max_bytes:
+                raise ValueError(f"File too large (> {max_bytes} bytes)")
+
+            if expected is None:
+                total = 0
+                chunks = []
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    if not chunk:
+                        continue
+                    total += len(chunk)
+                    if total > max_bytes:
+                        raise ValueError(f"File too large (> {max_bytes} bytes)")
+                    chunks.append(chunk)
+                logger.info("Downloaded bytes=%d", total)
+                return b"".join(chunks)
+
+            # known size: fill a preallocated buffer, no chunk list + join copy
+            buf = bytearray(expected)
+            mv = memoryview(buf)
+            off = 0
             for chunk in r.iter_content(chunk_size=64 * 1024):
                 if not chunk:
                     continue
-                total += len(chunk)
-                if total > max_bytes:
-                    raise ValueError(f"File too large (> {max_bytes} bytes)")
-                chunks.append(chunk)
-            logger.info("Downloaded bytes=%d", total)
-            return b"".join(chunks)
+                end = off + len(chunk)
+                if end > expected:
+                    logger.error("Download larger than Content-Length=%d", expected)
+                    return None
+                mv[off:end] = chunk
+                off = end
+            mv.release()
+            if off != expected:
+                logger.error("Download truncated: %d of %d bytes", off, expected)
+                return None
+            logger.info("Downloaded bytes=%d", off)
+            return buf
     except ValueError:
         raise
     except requests.RequestException as e:
@@ -445,66 +593,90 @@ def download_bytes(url: str, max_bytes: int) -> Optional[bytes]:
 # GIF -> MP4 (ffmpeg)
 # =======================
 
+_ffmpeg_exe: Optional[str] = None
+
+
 def find_ffmpeg_exe() -> Optional[str]:
-    for cmd in ("ffmpeg", "ffmpeg.exe"):
-        try:
-            p = subprocess.run([cmd, "-version"], capture_output=True, text=True)
-            if p.returncode == 0:
-                return cmd
-        except Exception:
-            pass
-    if imageio_ffmpeg is not None:
+    # only successes are cached, so installing ffmpeg later still gets picked up
+    global _ffmpeg_exe
+    if _ffmpeg_exe:
+        return _ffmpeg_exe
+    exe = shutil.which("ffmpeg")  # PATHEXT makes this find ffmpeg.exe on Windows
+    if not exe and imageio_ffmpeg is not None:
         try:
-            return imageio_ffmpeg.get_ffmpeg_exe()
+            exe = imageio_ffmpeg.get_ffmpeg_exe()
         except Exception:
-            return None
-    return None
+            exe = None
+    _ffmpeg_exe = exe
+    return exe
 
 
-def gif_bytes_to_mp4(gif_bytes: bytes) -> Optional[bytes]:
+def gif_bytes_to_mp4(gif_bytes: BytesLike, cancel: Optional[threading.Event] = None) -> Optional[bytes]:
+    if cancel is not None and cancel.is_set():
+        return None
     ffmpeg = find_ffmpeg_exe()
     if not ffmpeg:
         logger.error("FFmpeg not found. Install ffmpeg or `pip install imageio-ffmpeg`.")
         return None
 
-    with tempfile.TemporaryDirectory() as td:
-        in_gif = os.path.join(td, "in.gif")
-        out_mp4 = os.path.join(td, "out.mp4")
-
-        with open(in_gif, "wb") as f:
-            f.write(gif_bytes)
-
-        cmd = [
-            ffmpeg, "-y",
-            "-i", in_gif,
-            "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
-            "-movflags", "+faststart",
-            "-pix_fmt", "yuv420p",
-            "-c:v", "libx264",
-            "-preset", "veryfast",
-            "-crf", "28",
-            "-an",
-            out_mp4
-        ]
+    # GIF in via stdin, MP4 out via stdout: no temp files on disk.
+    # Output pipe is not seekable, so the MP4 must be fragmented.
+    cmd = [
+        ffmpeg, "-y",
+        "-f", "gif",
+        "-i", "pipe:0",
+        "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+        "-f", "mp4",
+        "-movflags", "+faststart+frag_keyframe+empty_moov",
+        "-pix_fmt", "yuv420p",
+        "-c:v", "libx264",
+        "-preset", "veryfast",
+        "-tune", "animation",
+        "-threads", "0",
+        "-x264-params", "rc-lookahead=10:ref=2",
+        "-crf", "28",
+        "-an",
+        "pipe:1"
+    ]
 
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except Exception as e:
+        logger.error("FFmpeg execution error: %s", e)
+        return None
+
+    # communicate() in short slices so a set `cancel` event kills ffmpeg promptly
+    deadline = time.monotonic() + FFMPEG_TIMEOUT
+    data: Optional[BytesLike] = gif_bytes
+    while True:
         try:
-            p = subprocess.run(cmd, capture_output=True, text=True)
+            # communicate() accepts any buffer at runtime; the stubs just say bytes
+            mp4, err = p.communicate(cast(Optional[bytes], data), timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            data = None  # input is already being fed; retries must not pass it again
+            if cancel is not None and cancel.is_set():
+                p.kill()
+                p.communicate()
+                logger.info("FFmpeg encode cancelled")
+                return None
+            if time.monotonic() >= deadline:
+                p.kill()
+                p.communicate()
+                logger.error("FFmpeg timeout (>%ss)", FFMPEG_TIMEOUT)
+                return None
         except Exception as e:
-            logger.error("FFmpeg execution error: %s", e)
+            p.kill()
+            p.communicate()
+            logger.error("FFmpeg pipe error: %s", e)
             return None
 
-        if p.returncode != 0:
-            logger.error("FFmpeg failed: %s", (p.stderr or "")[-400:])
-            return None
+    if p.returncode != 0 or not mp4:
+        logger.error("FFmpeg failed: %s", err.decode("utf-8", "replace")[-400:])
+        return None
 
-        try:
-            with open(out_mp4, "rb") as f:
-                mp4 = f.read()
-            logger.info("Converted GIF->MP4 bytes=%d", len(mp4))
-            return mp4
-        except Exception as e:
-            logger.error("Reading MP4 failed: %s", e)
-            return None
+    logger.info("Converted GIF->MP4 bytes=%d", len(mp4))
+    return mp4
 
 
 # =======================
@@ -519,19 +691,17 @@ def init_mastodon():
         access_token=MASTODON_ACCESS_TOKEN,
         api_base_url=MASTODON_BASE_URL,
         user_agent=USER_AGENT,
-        request_timeout=max(CONNECT_TIMEOUT + READ_TIMEOUT, 10.0),
+        request_timeout=MASTO_CALL_TIMEOUT,
     )
 
 
-def upload_media(mastodon, data: bytes, mime: str, alt_text: str) -> Optional[int]:
-    bio = io.BytesIO(data)
-    bio.name = "giffer." + ("mp4" if mime == "video/mp4" else "gif")
+def upload_media(mastodon, data: BytesLike, mime: str, alt_text: str) -> Optional[int]:
+    name = "giffer." + ("mp4" if mime == "video/mp4" else "gif")
     logger.info("Uploading media mime=%s (alt_len=%d)", mime, len(alt_text))
 
-    def _call():
-        return mastodon.media_post(media_file=bio, mime_type=mime, description=alt_text)
-
-    media = run_with_timeout(_call, MASTO_CALL_TIMEOUT, f"mastodon.media_post({mime})")
+    # Raw buffer goes straight into the multipart body (no io.BytesIO copy).
+    # Errors propagate: the caller inspects them for 422 "not supported".
+    media = mastodon.media_post(media_file=data, mime_type=mime, description=alt_text, file_name=name)
     if not media:
         return None
     return int(media["id"])
@@ -541,7 +711,11 @@ def wait_media_ready(mastodon, media_id: int, max_wait: float) -> bool:
     start = time.time()
     delay = 0.6
     while time.time() - start < max_wait:
-        att = run_with_timeout(lambda: mastodon.media(media_id), MASTO_CALL_TIMEOUT, "mastodon.media(get)")
+        try:
+            att = mastodon.media(media_id)
+        except Exception as e:
+            logger.error("Error in mastodon.media(get): %s", e)
+            att = None
         if att and att.get("url"):
             return True
         time.sleep(delay)
@@ -550,35 +724,27 @@ def wait_media_ready(mastodon, media_id: int, max_wait: float) -> bool:
 
 
 def post_reply_safe(mastodon, status_id: int, text: str, visibility: str) -> None:
-    def _call():
-        return mastodon.status_post(text, in_reply_to_id=status_id, visibility=visibility)
-    run_with_timeout(_call, MASTO_CALL_TIMEOUT, "mastodon.status_post(reply)")
+    try:
+        mastodon.status_post(text, in_reply_to_id=status_id, visibility=visibility)
+    except Exception as e:
+        logger.error("Error in mastodon.status_post(reply): %s", e)
 
 
 def post_status_with_media(mastodon, status_id: int, text: str, media_id: int,
                           visibility: str, nsfw: bool) -> bool:
-    if nsfw:
-        def _call():
-            return mastodon.status_post(
-                text,
-                in_reply_to_id=status_id,
-                media_ids=[media_id],
-                sensitive=True,
-                spoiler_text="NSFW",
-                visibility=visibility,
-            )
-        res = run_with_timeout(_call, MASTO_CALL_TIMEOUT, "mastodon.status_post(nsfw)")
-        return res is not None
-    else:
-        def _call():
-            return mastodon.status_post(
-                text,
-                in_reply_to_id=status_id,
-                media_ids=[media_id],
-                visibility=visibility,
-            )
-        res = run_with_timeout(_call, MASTO_CALL_TIMEOUT, "mastodon.status_post(sfw)")
-        return res is not None
+    extra: Dict[str, Any] = {"sensitive": True, "spoiler_text": "NSFW"} if nsfw else {}
+    try:
+        mastodon.status_post(
+            text,
+            in_reply_to_id=status_id,
+            media_ids=[media_id],
+            visibility=visibility,
+            **extra,
+        )
+        return True
+    except Exception as e:
+        logger.error("Error in mastodon.status_post(%s): %s", "nsfw" if nsfw else "sfw", e)
+        return False
 
 
 def is_mastodon_422_unsupported(err_msg: str) -> bool:
@@ -592,43 +758,85 @@ def upload_gif_then_mp4_fallback(mastodon, img: Dict[str, Any], alt: str) -> Tup
         return None, ""
 
     last_err = ""
+    rejected = False  # instance has already 422'd a GIF for this image
+    spec: Optional[Tuple[Future, threading.Event, BytesLike]] = None  # speculative MP4 encode + its source
+
+    def _cancel_spec() -> None:
+        if spec is not None:
+            spec[1].set()  # kills ffmpeg if it is already running
+            spec[0].cancel()
+
+    downloaded: Dict[str, Optional[BytesLike]] = {}  # url -> bytes (None = failed), never fetch twice
+
+    def _download(u: str) -> Optional[BytesLike]:
+        if u not in downloaded:
+            try:
+                downloaded[u] = download_bytes(u, MAX_GIF_BYTES)
+            except ValueError:
+                downloaded[u] = None  # too large: never fetch it again
+                raise
+        return downloaded[u]
 
     # GIF attempts (big -> small)
     for u in urls:
         try:
-            gif_bytes = download_bytes(u, MAX_GIF_BYTES)
+            gif_bytes = _download(u)
+        except ValueError as e:
+            # oversized: with Content-Length this costs no body bytes at all
+            logger.info("Skip %s: %s", u, e)
+            last_err = str(e)
+            continue
+        try:
             if not gif_bytes:
                 last_err = "download failed"
                 continue
+            if rejected:
+                # after a 422 the MP4 fallback is likely: encode this (smaller)
+                # GIF while its upload is in flight, replacing any larger encode
+                _cancel_spec()
+                ev = threading.Event()
+                spec = (_executor.submit(gif_bytes_to_mp4, gif_bytes, ev), ev, gif_bytes)
             mid = upload_media(mastodon, gif_bytes, "image/gif", alt)
             if mid is not None:
+                _cancel_spec()
                 return mid, "image/gif"
             last_err = "upload timeout/none"
         except Exception as e:
             last_err = str(e)
             if is_mastodon_422_unsupported(last_err):
+                rejected = True
                 logger.warning("GIF rejected (422) for %s: %s. Trying smaller...", u, last_err)
                 continue
             logger.error("GIF upload failed hard: %s", last_err)
             break
 
-    # MP4 fallback (use smallest downloadable gif)
     logger.info("Trying MP4 fallback...")
-    gif_bytes = None
-    for u in reversed(urls):
-        b = download_bytes(u, MAX_GIF_BYTES)
-        if b:
-            gif_bytes = b
-            break
+    # MP4 fallback: convert the smallest GIF we have, reusing earlier downloads
+    gif_bytes = min((b for b in downloaded.values() if b), key=len, default=None)
+    if gif_bytes is None:
+        for u in reversed(urls):
+            gif_bytes = _download(u)
+            if gif_bytes:
+                break
     if not gif_bytes:
+        _cancel_spec()
         logger.error("Cannot download any GIF for MP4 conversion. Last error: %s", last_err)
         return None, ""
 
-    mp4 = gif_bytes_to_mp4(gif_bytes)
+    if spec is not None and spec[2] is gif_bytes:
+        mp4 = spec[0].result()  # the speculative encode already has the right source
+    else:
+        _cancel_spec()
+        mp4 = gif_bytes_to_mp4(gif_bytes)
+
     if not mp4:
         return None, ""
 
-    mid = upload_media(mastodon, mp4, "video/mp4", alt)
+    try:
+        mid = upload_media(mastodon, mp4, "video/mp4", alt)
+    except Exception as e:
+        logger.error("MP4 upload failed: %s", e)
+        return None, ""
     if mid is None:
         return None, ""
     return mid, "video/mp4"
@@ -644,6 +852,81 @@ def reply_text(prefix: str, query: str, src: str, used_mime: str) -> str:
     return f"{prefix} по запросу: `{q}`{note}\nОриг: {src}"
 
 
+def _handle_notif(mastodon, acct: str, status: Dict[str, Any], status_id_int: int) -> None:
+    from mastodon import MastodonError
+
+    query, is_nsfw = parse_query(status.get("content", ""))
+    logger.info("Mention from=%s nsfw=%s query=%r status_id=%s", acct, is_nsfw, query, status_id_int)
+
+    try:
+        img = furbooru_search_gif(query, is_nsfw)
+        if not img:
+            post_reply_safe(
+                mastodon,
+                status_id_int,
+                f"Ничего не нашёл по запросу: `{query or 'random'}` 😿",
+                safe_visibility(status.get("visibility", "public")),
+            )
+            return
+
+        src = source_link(img)
+        alt = make_alt_text(img, query, is_nsfw)
+
+        media_id, used_mime = upload_gif_then_mp4_fallback(mastodon, img, alt)
+        if not media_id:
+            post_reply_safe(
+                mastodon,
+                status_id_int,
+                "Не смог загрузить (инстанс отклоняет GIF/видео или проблемы сети). Попробуй другой запрос 🙏",
+                safe_visibility(status.get("visibility", "public")),
+            )
+            return
+
+        logger.info("Uploaded media_id=%s mime=%s. Waiting processing...", media_id, used_mime)
+        if not wait_media_ready(mastodon, media_id, max_wait=MEDIA_PROCESS_MAX_WAIT):
+            post_reply_safe(
+                mastodon,
+                status_id_int,
+                "Медиа загрузилось, но Mastodon слишком долго его обрабатывает. Попробуй ещё раз через минуту 🙏",
+                safe_visibility(status.get("visibility", "public")),
+            )
+            return
+
+        visibility = safe_visibility(NSFW_VISIBILITY if is_nsfw else status.get("visibility", "public"))
+        text = reply_text("NSFW" if is_nsfw else "GIF", query, src, used_mime)
+
+        posted = post_status_with_media(mastodon, status_id_int, text, media_id, visibility, nsfw=is_nsfw)
+        if posted:
+            logger.info("Posted successfully for user=%s", acct)
+        else:
+            logger.error("Failed to post status for user=%s (status_id=%s)", acct, status_id_int)
+
+    except ValueError as e:
+        post_reply_safe(
+            mastodon,
+            status_id_int,
+            f"Не могу загрузить: {e}",
+            safe_visibility(status.get("visibility", "public")),
+        )
+    except requests.RequestException as e:
+        post_reply_safe(
+            mastodon,
+            status_id_int,
+            f"Ошибка сети: {e}",
+            safe_visibility(status.get("visibility", "public")),
+        )
+    except MastodonError as e:
+        logger.error("Mastodon error: %s", e)
+    except Exception as e:
+        logger.exception("Unexpected error: %s", e)
+        post_reply_safe(
+            mastodon,
+            status_id_int,
+            f"Неожиданная ошибка: {e}",
+            safe_visibility(status.get("visibility", "public")),
+        )
+
+
 def main():
     state = load_state()
     last_seen_id = state.get("last_seen_notif_id", None)
@@ -655,37 +938,34 @@ def main():
     except Exception:
         last_seen_id = None
 
-    processed_set = set(int(x) for x in state.get("processed_status_ids", []) if isinstance(x, int) or str(x).isdigit())
-    # normalize back into state list
-    state["processed_status_ids"] = list(processed_set)[-PROCESSED_CACHE_MAX:]
     save_state(state)
 
     mastodon = init_mastodon()
-    from mastodon import MastodonError
 
     logger.info("Starting giffer bot on %s (Furbooru: %s)", MASTODON_BASE_URL, FURBOORU_BASE_URL)
-    logger.info("Loaded state: last_seen_notif_id=%s processed_cache=%d", last_seen_id, len(state["processed_status_ids"]))
+    logger.info("Loaded state: last_seen_notif_id=%s processed_cache=%d", last_seen_id, len(state["processed_deque"]))
 
     while True:
         logger.info("Polling mentions... since_id=%s", last_seen_id)
 
-        def _fetch():
-            return mastodon.notifications(types=["mention"], since_id=last_seen_id)
-
-        notifs = run_with_timeout(_fetch, MASTO_CALL_TIMEOUT, "mastodon.notifications(mention)")
+        try:
+            notifs = mastodon.notifications(types=["mention"], since_id=last_seen_id)
+        except Exception as e:
+            logger.error("Error in mastodon.notifications(mention): %s", e)
+            notifs = None
         if notifs is None:
             time.sleep(CHECK_INTERVAL)
             continue
 
         logger.info("Got %d mention notifications", len(notifs))
 
+        futures: List[Future] = []
         for notif in reversed(notifs):
             notif_id = notif.get("id")
             if notif_id is not None:
                 try:
                     last_seen_id = int(notif_id)
                     state["last_seen_notif_id"] = last_seen_id
-                    save_state(state)  # <- important: persist immediately
                 except Exception:
                     pass
 
@@ -701,89 +981,33 @@ def main():
                 continue
 
             # ---- NEW: don't reply twice ----
-            if status_id_int in processed_set:
+            if is_processed(state, status_id_int):
                 logger.info("Skipping already processed status_id=%s", status_id_int)
                 continue
 
-            # mark as processed early to prevent double-processing if we crash mid-way
-            processed_set.add(status_id_int)
+            # mark as processed early to prevent double-processing if we crash mid-way;
+            # this single write also persists last_seen_notif_id
             remember_processed(state, status_id_int)
             save_state(state)
 
+            # user cooldown and state are only touched here, on the polling thread
             if not user_allowed(acct):
                 continue
 
-            query, is_nsfw = parse_query(status.get("content", ""))
-            logger.info("Mention from=%s nsfw=%s query=%r status_id=%s", acct, is_nsfw, query, status_id_int)
-
-            try:
-                img = furbooru_search_gif(query, is_nsfw)
-                if not img:
-                    post_reply_safe(
-                        mastodon,
-                        status_id_int,
-                        f"Ничего не нашёл по запросу: `{query or 'random'}` 😿",
-                        safe_visibility(status.get("visibility", "public")),
-                    )
-                    continue
-
-                src = source_link(img)
-                alt = make_alt_text(img, query, is_nsfw)
-
-                media_id, used_mime = upload_gif_then_mp4_fallback(mastodon, img, alt)
-                if not media_id:
-                    post_reply_safe(
-                        mastodon,
-                        status_id_int,
-                        "Не смог загрузить (инстанс отклоняет GIF/видео или проблемы сети). Попробуй другой запрос 🙏",
-                        safe_visibility(status.get("visibility", "public")),
-                    )
-                    continue
-
-                logger.info("Uploaded media_id=%s mime=%s. Waiting processing...", media_id, used_mime)
-                if not wait_media_ready(mastodon, media_id, max_wait=MEDIA_PROCESS_MAX_WAIT):
-                    post_reply_safe(
-                        mastodon,
-                        status_id_int,
-                        "Медиа загрузилось, но Mastodon слишком долго его обрабатывает. Попробуй ещё раз через минуту 🙏",
-                        safe_visibility(status.get("visibility", "public")),
-                    )
-                    continue
-
-                visibility = safe_visibility(NSFW_VISIBILITY if is_nsfw else status.get("visibility", "public"))
-                text = reply_text("NSFW" if is_nsfw else "GIF", query, src, used_mime)
-
-                posted = post_status_with_media(mastodon, status_id_int, text, media_id, visibility, nsfw=is_nsfw)
-                if posted:
-                    logger.info("Posted successfully for user=%s", acct)
-                else:
-                    logger.error("Failed to post status for user=%s (status_id=%s)", acct, status_id_int)
-
-            except ValueError as e:
-                post_reply_safe(
-                    mastodon,
-                    status_id_int,
-                    f"Не могу загрузить: {e}",
-                    safe_visibility(status.get("visibility", "public")),
-                )
-            except requests.RequestException as e:
-                post_reply_safe(
-                    mastodon,
-                    status_id_int,
-                    f"Ошибка сети: {e}",
-                    safe_visibility(status.get("visibility", "public")),
-                )
-            except MastodonError as e:
-                logger.error("Mastodon error: %s", e)
-            except Exception as e:
-                logger.exception("Unexpected error: %s", e)
-                post_reply_safe(
-                    mastodon,
-                    status_id_int,
-                    f"Неожиданная ошибка: {e}",
-                    safe_visibility(status.get("visibility", "public")),
-                )
+            futures.append(_notif_executor.submit(_handle_notif, mastodon, acct, status, status_id_int))
 
+        # mentions are independent: let them overlap, but don't start the next poll until done
+        try:
+            for fut in as_completed(futures, timeout=CHECK_INTERVAL * 3):
+                try:
+                    fut.result()
+                except Exception as e:
+                    logger.exception("Mention handler crashed: %s", e)
+        except FuturesTimeoutError:
+            logger.error("Mention handlers still running after %ss. Continuing.", CHECK_INTERVAL * 3)
+
+        # persist last_seen_notif_id for skipped notifications (no-op if unchanged)
+        save_state(state)
         time.sleep(CHECK_INTERVAL)
 
 